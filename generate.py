@@ -1,5 +1,6 @@
+import heapq
 import sys
-from copy import deepcopy
+from collections import deque
 from crossword import *
 
 
@@ -10,10 +11,45 @@ class CrosswordCreator():
         Create new CSP crossword generate.
         """
         self.crossword = crossword
+        # Bucket the vocabulary by length once, so every domain starts out
+        # node-consistent without scanning the whole vocabulary per variable
+        wordsByLength = {}
+        for word in self.crossword.words:
+            wordsByLength.setdefault(len(word), set()).add(word)
         self.domains = {
-            var: self.crossword.words.copy()
+            var: wordsByLength.get(var.length, set()).copy()
             for var in self.crossword.variables
         }
+        # The crossword graph never changes, so look up each neighbour set once
+        self.neighbors = {
+            var: frozenset(self.crossword.neighbors(var))
+            for var in self.domains
+        }
+        # Each variable's neighbours mapped to their overlap (i, j), so one
+        # lookup per variable serves all of its overlaps
+        self._ov = {
+            var: {
+                neighbour: self.crossword.overlaps[var, neighbour]
+                for neighbour in self.neighbors[var]
+            }
+            for var in self.domains
+        }
+        # Words used by the assignment `backtrack` is currently extending
+        self._assigned_words = set()
+        # (variable, removed words, requeue) for every pruning made during a
+        # search, so it can be undone; None while no search is running
+        self.trail = None
+        self.degree = {
+            var: len(self.neighbors[var])
+            for var in self.domains
+        }
+        # Lazy MRV/degree heap of (domain size, -degree, id, variable) entries,
+        # and the domains dict it was last rebuilt from
+        self._variable_heap = []
+        self._heap_domains = None
+        # Variables `backtrack` is currently assigning; None means all of them
+        self._scope = None
+        self.build_letter_index()
 
     def letter_grid(self, assignment):
         """
@@ -24,11 +60,15 @@ class CrosswordCreator():
             for _ in range(self.crossword.height)
         ]
         for variable, word in assignment.items():
-            direction = variable.direction
-            for k in range(len(word)):
-                i = variable.i + (k if direction == Variable.DOWN else 0)
-                j = variable.j + (k if direction == Variable.ACROSS else 0)
-                letters[i][j] = word[k]
+            # Read the variable's attributes once rather than per letter
+            i, j = variable.i, variable.j
+            if variable.direction == Variable.DOWN:
+                for k, letter in enumerate(word):
+                    letters[i + k][j] = letter
+            else:
+                row = letters[i]
+                for k, letter in enumerate(word):
+                    row[j + k] = letter
         return letters
 
     def print(self, assignment):
@@ -37,12 +77,10 @@ class CrosswordCreator():
         """
         letters = self.letter_grid(assignment)
         for i in range(self.crossword.height):
-            for j in range(self.crossword.width):
-                if self.crossword.structure[i][j]:
-                    print(letters[i][j] or " ", end="")
-                else:
-                    print("█", end="")
-            print()
+            print("".join(
+                (letters[i][j] or " ") if self.crossword.structure[i][j] else "█"
+                for j in range(self.crossword.width)
+            ))
 
     def save(self, assignment, filename):
         """
@@ -54,34 +92,52 @@ class CrosswordCreator():
         interior_size = cell_size - 2 * cell_border
         letters = self.letter_grid(assignment)
 
-        # Create a blank canvas
-        img = Image.new(
-            "RGBA",
+        # Paint every cell's white interior into one greyscale buffer, so the
+        # canvas is built by a single PIL call rather than one per cell.
+        # Interiors span the inclusive pixel range used by draw.rectangle.
+        interior = interior_size + 1
+        blank_cell = bytes(cell_size)
+        white_cell = (
+            bytes(cell_border)
+            + b"\xff" * interior
+            + bytes(cell_size - cell_border - interior)
+        )
+        blank_line = bytes(self.crossword.width * cell_size)
+        rows = []
+        for i in range(self.crossword.height):
+            line = b"".join(
+                white_cell if self.crossword.structure[i][j] else blank_cell
+                for j in range(self.crossword.width)
+            )
+            rows.append(
+                blank_line * cell_border
+                + line * interior
+                + blank_line * (cell_size - cell_border - interior)
+            )
+        img = Image.frombytes(
+            "L",
             (self.crossword.width * cell_size,
              self.crossword.height * cell_size),
-            "black"
-        )
+            b"".join(rows)
+        ).convert("RGBA")
         font = ImageFont.truetype("assets/fonts/OpenSans-Regular.ttf", 80)
         draw = ImageDraw.Draw(img)
 
+        # Only filled cells need drawing now; measure each letter once
+        sizes = {}
         for i in range(self.crossword.height):
             for j in range(self.crossword.width):
-
-                rect = [
-                    (j * cell_size + cell_border,
-                     i * cell_size + cell_border),
-                    ((j + 1) * cell_size - cell_border,
-                     (i + 1) * cell_size - cell_border)
-                ]
-                if self.crossword.structure[i][j]:
-                    draw.rectangle(rect, fill="white")
-                    if letters[i][j]:
-                        _, _, w, h = draw.textbbox((0, 0), letters[i][j], font=font)
-                        draw.text(
-                            (rect[0][0] + ((interior_size - w) / 2),
-                             rect[0][1] + ((interior_size - h) / 2) - 10),
-                            letters[i][j], fill="black", font=font
-                        )
+                letter = letters[i][j]
+                if self.crossword.structure[i][j] and letter:
+                    if letter not in sizes:
+                        _, _, w, h = draw.textbbox((0, 0), letter, font=font)
+                        sizes[letter] = (w, h)
+                    w, h = sizes[letter]
+                    draw.text(
+                        (j * cell_size + cell_border + ((interior_size - w) / 2),
+                         i * cell_size + cell_border + ((interior_size - h) / 2) - 10),
+                        letter, fill="black", font=font
+                    )
 
         img.save(filename)
 
@@ -90,21 +146,166 @@ class CrosswordCreator():
         Enforce node and arc consistency, and then solve the CSP.
         """
         self.enforce_node_consistency()
-        self.ac3()
-        return self.backtrack(dict())
+        if not self.ac3():
+            return None
+        self._assigned_words = set()
+        self.trail = []
+        try:
+            # Components share no arcs, so each is searched on its own. Only
+            # the no-repeated-words rule links them: if a later component
+            # fails, the words taken by earlier ones may be to blame.
+            components = self.components()
+            assignment = dict()
+            for component in components:
+                self._scope = component
+                self._variable_heap = []
+                result = self.backtrack(dict())
+                if result is None:
+                    break
+                assignment.update(result)
+            else:
+                return assignment
+
+            # If no earlier component took any words, the failure is genuine
+            if not assignment:
+                return None
+
+            # Otherwise search the failed component alone, free of those
+            # words. If it fails even so, the crossword has no solution
+            self._assigned_words = set()
+            self._variable_heap = []
+            if self.backtrack(dict()) is None:
+                return None
+
+            # Only the shared words stood in its way, so search everything
+            # together
+            self._scope = None
+            self.undo_to(0)
+            self._assigned_words = set()
+            self._variable_heap = []
+            return self.backtrack(dict())
+        finally:
+            self.trail = None
+            self._scope = None
+
+    def components(self):
+        """
+        Partition the variables into connected components of the crossword
+        graph, returned as a list of sets.
+        """
+        parent = {var: var for var in self.domains}
+
+        def find(var):
+            while parent[var] is not var:
+                parent[var] = parent[parent[var]]
+                var = parent[var]
+            return var
+
+        for var in self.domains:
+            for neighbour in self.neighbors[var]:
+                parent[find(var)] = find(neighbour)
+
+        components = {}
+        for var in self.domains:
+            components.setdefault(find(var), set()).add(var)
+        return list(components.values())
 
     def enforce_node_consistency(self):
         """
         Update `self.domains` such that each variable is node-consistent.
         (Remove any values that are inconsistent with a variable's unary
          constraints; in this case, the length of the word.)
+
+        The domains are built from length buckets in `__init__`, so they are
+        already node-consistent and there is nothing left to do here.
+        """
+
+    def build_letter_index(self):
         """
+        Index every domain by letter position, so that
+        `self.letter_index[var][k][letter]` is the set of words in
+        `self.domains[var]` whose kth letter is `letter`.
+        """
+        self.letter_index = {}
+        # The domain set each index was built from, and that set's size
+        self._indexed = {}
         for var in self.domains:
-            newSet = set()
-            for word in self.domains[var]:
-                if len(word) == var.length:
-                    newSet.add(word)
-            self.domains[var] = newSet
+            self._index_variable(var)
+
+    def _index_variable(self, var):
+        """
+        Rebuild `self.letter_index[var]` from `self.domains[var]`.
+        """
+        domain = self.domains[var]
+        positions = {k: {} for k in range(var.length)}
+        for word in domain:
+            for k, letter in enumerate(word):
+                positions[k].setdefault(letter, set()).add(word)
+        self.letter_index[var] = positions
+        self._indexed[var] = (domain, len(domain))
+
+    def _letters(self, var):
+        """
+        Return `self.letter_index[var]`, first rebuilding it if
+        `self.domains[var]` was replaced or resized other than through
+        `prune` and `undo_to`.
+        """
+        domain, size = self._indexed[var]
+        if domain is not self.domains[var] or size != len(domain):
+            self._index_variable(var)
+        return self.letter_index[var]
+
+    def prune(self, var, words, requeue=True):
+        """
+        Remove `words` from the domain of `var`, keeping `self.letter_index`
+        in step. A letter whose bucket empties is dropped from the index.
+        With `requeue` False, `var` is not pushed onto the variable heap,
+        neither now nor when the pruning is undone.
+        """
+        positions = self._letters(var)
+        domain = self.domains[var]
+        domain -= words
+        self._indexed[var] = (domain, len(domain))
+        if self.trail is not None:
+            self.trail.append((var, words, requeue))
+        if requeue:
+            self._push_variable(var)
+        for word in words:
+            for k, letter in enumerate(word):
+                bucket = positions[k][letter]
+                bucket.discard(word)
+                if not bucket:
+                    del positions[k][letter]
+
+    def _push_variable(self, var):
+        """
+        Record the current domain size of `var` on the variable heap.
+        """
+        # Stale entries are only dropped when they reach the top, so start
+        # afresh before the heap outgrows a few entries per variable
+        if len(self._variable_heap) >= 4 * len(self._variables()):
+            self._rebuild_variable_heap()
+        else:
+            heapq.heappush(
+                self._variable_heap,
+                (len(self.domains[var]), -self.degree[var], id(var), var)
+            )
+
+    def undo_to(self, mark):
+        """
+        Restore every word pruned since `self.trail` had length `mark`.
+        """
+        while len(self.trail) > mark:
+            var, words, requeue = self.trail.pop()
+            positions = self._letters(var)
+            domain = self.domains[var]
+            domain |= words
+            self._indexed[var] = (domain, len(domain))
+            if requeue:
+                self._push_variable(var)
+            for word in words:
+                for k, letter in enumerate(word):
+                    positions[k].setdefault(letter, set()).add(word)
 
     def revise(self, x, y):
         """
@@ -115,21 +316,21 @@ class CrosswordCreator():
         Return True if a revision was made to the domain of `x`; return
         False if no revision was made.
         """
-        xIntersectionIndex = self.crossword.overlaps[x, y][0]
-        yIntersectionIndex = self.crossword.overlaps[x, y][1]
+        xIntersectionIndex, yIntersectionIndex = self._ov[x][y]
 
-        newXDomain = set()
+        xBuckets = self._letters(x)[xIntersectionIndex]
+        yBuckets = self._letters(y)[yIntersectionIndex]
 
-        for xWord in self.domains[x]:
-            if any(xWord[xIntersectionIndex] == yWord[yIntersectionIndex] for yWord in self.domains[y]):
-                newXDomain.add(xWord)
+        # Drop whole letter buckets of x that y cannot match at the shared cell
+        unsupported = set()
+        for letter in xBuckets.keys() - yBuckets.keys():
+            unsupported |= xBuckets[letter]
 
-        revisionMade = not (newXDomain == self.domains[x])
+        if unsupported:
+            self.prune(x, unsupported)
+            return True
 
-        if revisionMade:
-            self.domains[x] = deepcopy(newXDomain)
-
-        return revisionMade
+        return False
 
     def ac3(self, arcs=None):
         """
@@ -141,74 +342,95 @@ class CrosswordCreator():
         return False if one or more domains end up empty.
         """
         if arcs == None:
-            arcs = []
-            for var in self.domains:
-                for neighbour in self.crossword.neighbors(var):
-                    arcs.append((var, neighbour))
-        
-        while len(arcs) != 0:
-            nextArc = arcs.pop(0)
-            
-            if self.revise(nextArc[0], nextArc[1]):
-                if len(self.domains[nextArc[0]]) == 0:
+            arcs = deque(
+                (var, neighbour)
+                for var in self.domains
+                for neighbour in self.neighbors[var]
+            )
+        else:
+            arcs = deque(arcs)
+
+        # Arcs currently waiting in the queue, so the same arc is never queued twice
+        queued = set(arcs)
+
+        # Bind the loop's lookups locally; this loop dominates solve time
+        revise = self.revise
+        domains = self.domains
+        neighbors = self.neighbors
+        popArc, pushArc = arcs.popleft, arcs.append
+        unqueue, enqueue = queued.discard, queued.add
+
+        while arcs:
+            nextArc = popArc()
+            unqueue(nextArc)
+            x, y = nextArc
+
+            if revise(x, y):
+                if not domains[x]:
                     return False
-                
-                # Iterates through a list containing all the neighbours of nextArc[0] except nextArc[1]
-                for neighbour in [item for item in self.crossword.neighbors(nextArc[0]) if item != nextArc[1]]:
-                    arcs.append((neighbour, nextArc[0]))
+
+                # Requeue the arcs into x from all of its neighbours except y
+                for neighbour in neighbors[x] - {y}:
+                    arc = (neighbour, x)
+                    if arc not in queued:
+                        pushArc(arc)
+                        enqueue(arc)
 
         return True
 
     def assignment_complete(self, assignment):
         """
         Return True if `assignment` is complete (i.e., assigns a value to each
-        crossword variable); return False otherwise.
+        crossword variable being solved); return False otherwise.
         """
-        for variable in self.domains:
-            if variable not in assignment:
-                return False
-            if type(assignment[variable]) != str:
-                return False
+        return len(assignment) == len(self._variables())
 
-        return True
+    def _variables(self):
+        """
+        Return the variables `backtrack` is currently assigning.
+        """
+        return self.domains if self._scope is None else self._scope
 
     def consistent(self, assignment):
         """
         Return True if `assignment` is consistent (i.e., words fit in crossword
         puzzle without conflicting characters); return False otherwise.
         """
-        keys = [key for key in assignment]
         # If duplicate word present...
-        for keyIndex in range(len(assignment)):
-            for nestedKeyIndex in range(keyIndex+1, len(assignment)):
-                if assignment[keys[keyIndex]] == assignment[keys[nestedKeyIndex]]:
-                    return False
+        if len(set(assignment.values())) != len(assignment):
+            return False
 
         # If word length incorrect for variable...
         for variable in assignment:
             if variable.length != len(assignment[variable]):
                 return False
         
-        # Contains all arcs in the assignment
-        arcs = []
-        for var in assignment:
-            for neighbour in [item for item in self.crossword.neighbors(var) if item in assignment]:
-                arcs.append((var, neighbour))
-        
         # If any arc in assignment is inconsistent...
-        for arc in arcs:
-            x = arc[0]
-            y = arc[1]
-
-            xIntersectionIndex = self.crossword.overlaps[x, y][0]
-            yIntersectionIndex = self.crossword.overlaps[x, y][1]
-
-            if assignment[x][xIntersectionIndex] != assignment[y][yIntersectionIndex]:
-                return False
+        for x in assignment:
+            for y, (xIntersectionIndex, yIntersectionIndex) in self._ov[x].items():
+                if y not in assignment:
+                    continue
+                if assignment[x][xIntersectionIndex] != assignment[y][yIntersectionIndex]:
+                    return False
         
         # Otherwise assignment is consistent
         return True
-        
+
+    def _consistent_extension(self, var, value, assignment):
+        """
+        Return True if assigning `value` to `var` keeps an already consistent
+        `assignment` consistent, checking only the constraints on `var`.
+        """
+        if value in self._assigned_words:
+            return False
+
+        for neighbour, (varIndex, neighbourIndex) in self._ov[var].items():
+            if neighbour in assignment:
+                if value[varIndex] != assignment[neighbour][neighbourIndex]:
+                    return False
+
+        return True
+
     def order_domain_values(self, var, assignment):
         """
         Return a list of values in the domain of `var`, in order by
@@ -216,22 +438,27 @@ class CrosswordCreator():
         The first value in the list, for example, should be the one
         that rules out the fewest values among the neighbors of `var`.
         """
-        domainOnChoices = {}
-
-        for domain in self.domains[var]:
-            choicesRuledOut = 0
-
-            for neighbour in [item for item in self.crossword.neighbors(var) if item not in assignment]:
-                for neighbourDomain in self.domains[neighbour]:
-                    varIntersectionIndex = self.crossword.overlaps[var, neighbour][0]
-                    neighbourIntersectionIndex = self.crossword.overlaps[var, neighbour][1]
-
-                    if domain[varIntersectionIndex] != neighbourDomain[neighbourIntersectionIndex]:
-                        choicesRuledOut += 1
+        # For each unassigned neighbour: var's overlap index, its domain size
+        # and its letter buckets at the overlap
+        overlaps = []
+        for neighbour, (varIndex, neighbourIndex) in self._ov[var].items():
+            if neighbour not in assignment:
+                overlaps.append((
+                    varIndex,
+                    len(self.domains[neighbour]),
+                    self._letters(neighbour)[neighbourIndex]
+                ))
+
+        # Neighbour words that do not share each value's letter at the overlap
+        choicesRuledOut = {
+            value: sum(
+                domainSize - len(letterBuckets.get(value[varIntersectionIndex], ()))
+                for varIntersectionIndex, domainSize, letterBuckets in overlaps
+            )
+            for value in self.domains[var]
+        }
 
-            domainOnChoices[domain] = choicesRuledOut
-        
-        return sorted(domainOnChoices, key=lambda k: domainOnChoices[k])
+        return sorted(self.domains[var], key=choicesRuledOut.__getitem__)
 
     def select_unassigned_variable(self, assignment):
         """
@@ -240,33 +467,40 @@ class CrosswordCreator():
         in its domain. If there is a tie, choose the variable with the highest
         degree. If there is a tie, any of the tied variables are acceptable
         return values.
-        """
-        fewestRemainingDomains = {}
-
-        lowestDomainVal = float('inf')
-        for variable in [var for var in self.domains if var not in assignment]:
-            if len(self.domains[variable]) < lowestDomainVal:
-                lowestDomainVal = len(self.domains[variable])
-                fewestRemainingDomains.clear()
-                fewestRemainingDomains[variable] = lowestDomainVal
-            elif len(self.domains[variable]) == lowestDomainVal:
-                fewestRemainingDomains[variable] = lowestDomainVal
 
-        if len(fewestRemainingDomains) == 1:
-            return [key for key in fewestRemainingDomains][0]
-        
-        else:
-            largestDegree = {}
-            largestDegreeVal = 0
-            for variable in fewestRemainingDomains:
-                if len(self.crossword.neighbors(variable)) > largestDegreeVal:
-                    largestDegreeVal = len(self.crossword.neighbors(variable))
-                    largestDegree.clear()
-                    largestDegree[variable] = largestDegreeVal
-                elif len(self.crossword.neighbors(variable)) == largestDegreeVal:
-                    largestDegree[variable] = largestDegreeVal
-
-        return [key for key in largestDegree][0]
+        Domain sizes come from a heap kept up to date by `prune` and
+        `undo_to`. The heap is rebuilt when `self.domains` is replaced as a
+        whole, but changes made to individual domains by other means are
+        not seen.
+        """
+        if self._heap_domains is not self.domains:
+            self._rebuild_variable_heap(assignment)
+        heap = self._variable_heap
+        scope = self._variables()
+
+        # Entries go stale once their variable is assigned or its domain changes
+        while heap:
+            size, _, _, variable = heap[0]
+            if (variable in scope and variable not in assignment
+                    and size == len(self.domains[variable])):
+                return variable
+            heapq.heappop(heap)
+
+        # Nothing usable left on the heap, so rebuild it from the domains
+        self._rebuild_variable_heap(assignment)
+        return self._variable_heap[0][3]
+
+    def _rebuild_variable_heap(self, assignment=()):
+        """
+        Replace the variable heap with one fresh entry per variable being
+        solved that is not in `assignment`.
+        """
+        self._variable_heap = [
+            (len(self.domains[var]), -self.degree[var], id(var), var)
+            for var in self._variables() if var not in assignment
+        ]
+        heapq.heapify(self._variable_heap)
+        self._heap_domains = self.domains
 
     def backtrack(self, assignment):
         """
@@ -277,21 +511,46 @@ class CrosswordCreator():
 
         If no assignment is possible, return None.
         """
+        if self.trail is None:
+            # Outermost call: track used words and prunings for this search only
+            self._assigned_words = set(assignment.values())
+            self.trail = []
+            try:
+                return self.backtrack(assignment)
+            finally:
+                self.trail = None
+
         if self.assignment_complete(assignment):
             return assignment
         
         var = self.select_unassigned_variable(assignment)
 
-        for value in self.domains[var]:
-            assignmentCopy = deepcopy(assignment)
-            assignmentCopy[var] = value
-            if self.consistent(assignmentCopy):
-                assignment[var] = value
+        for value in self.order_domain_values(var, assignment):
+            if not self._consistent_extension(var, value, assignment):
+                continue
+
+            mark = len(self.trail)
+            assignment[var] = value
+            self._assigned_words.add(value)
+
+            # Maintain arc consistency: shrink var to its value and propagate.
+            # var is assigned until this try is undone, so keep it off the heap
+            self.prune(var, self.domains[var] - {value}, requeue=False)
+            arcs = [
+                (neighbour, var) for neighbour in self.neighbors[var]
+                if neighbour not in assignment
+            ]
+            if self.ac3(arcs):
                 result = self.backtrack(assignment)
-                if result != None:
+                if result is not None:
                     return result
-                assignment = deepcopy(assignmentCopy)
-                
+
+            self.undo_to(mark)
+            del assignment[var]
+            self._assigned_words.discard(value)
+
+        # var is unassigned again for the caller's next choice
+        self._push_variable(var)
         return None
 
 